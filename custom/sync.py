@@ -2,133 +2,864 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import concurrent.futures
+import contextlib
+import errno
+import functools
+import gzip
+import http.client
+import json
 import os
+import re
+import socket
 import subprocess
 import sys
 import shutil
+import ssl
+import stat
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
 import urllib.error
 
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
 
-def run(cmd, env=None, cwd=None):
-    """执行命令并打印输出"""
-    print(">>", " ".join(cmd))
-    result = subprocess.run(
-        cmd,
-        cwd=cwd,
-        env=env,
-        stdout=sys.stdout,
-        stderr=sys.stderr,
-    )
-    if result.returncode != 0:
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def run(cmd, env=None, cwd=None, check=True):
+    """执行命令并打印输出，check 为 False 时返回退出码而不是直接退出"""
+    # 先刷新缓冲区，保证输出被重定向到管道时命令行提示与 git 输出的先后顺序一致
+    print(">>", " ".join(cmd), flush=True)
+    # 子进程直接继承标准输出/错误的文件描述符，输出不经过 Python
+    result = subprocess.run(cmd, cwd=cwd, env=env)
+    if check and result.returncode != 0:
         sys.exit(result.returncode)
+    return result.returncode
+
+
+def git_clone(repo_url, dest, branch, args, env):
+    """浅克隆仓库（安装了 pygit2 时在进程内完成，否则调用 git 命令）"""
+    if pygit2 is not None:
+        print(">> pygit2 clone --depth 1 -b", branch, repo_url, dest)
+        try:
+            pygit2.clone_repository(
+                repo_url,
+                dest,
+                checkout_branch=branch,
+                depth=1,
+                proxy=args.http_proxy or True,
+            )
+            return
+        except (pygit2.GitError, TypeError) as e:
+            # 本地传输不支持浅克隆、SSH/令牌认证没有凭据回调、旧版 pygit2 不支持 depth 参数时都交给 git 命令
+            print(f"pygit2 克隆失败，改用 git 命令: {e}")
+            shutil.rmtree(dest, ignore_errors=True)
+
+    run(["git", "clone", "--depth", "1", "-b", branch, repo_url, dest], env=env)
+
+
+def pygit2_pull(dest, branch, args):
+    """使用 pygit2 拉取并快进当前分支，成功返回 True；无法处理时返回 False 交给 git 命令"""
+    try:
+        repo = pygit2.Repository(dest)
+
+        # libgit2 不支持 sparse-checkout，稀疏仓库交给 git 命令处理
+        if "core.sparseCheckout" in repo.config and repo.config.get_bool("core.sparseCheckout"):
+            return False
+        if repo.head_is_detached or repo.head.shorthand != branch:
+            return False
+
+        remote_ref_name = f"refs/remotes/origin/{branch}"
+        if repo.is_shallow:
+            # 浅克隆仓库必须保持 depth=1 拉取，否则 libgit2 可能删除 .git/shallow 而不补全历史；
+            # 新提交与本地提交之间没有可比较的历史，只在本地没有额外提交时直接更新到远程版本
+            remote_ref = repo.references.get(remote_ref_name)
+            if remote_ref is None or remote_ref.target != repo.head.target:
+                return False
+            # 工作区有改动（含未跟踪文件）时检出可能失败，留下无法与 git pull 合并的浅历史，直接交给 git 命令
+            if any(flags != pygit2.GIT_STATUS_IGNORED for flags in repo.status().values()):
+                return False
+            print(">> pygit2 fetch --depth 1 origin")
+            repo.remotes["origin"].fetch(proxy=args.http_proxy or True, depth=1)
+        else:
+            print(">> pygit2 fetch origin")
+            repo.remotes["origin"].fetch(proxy=args.http_proxy or True)
+
+        remote_ref = repo.references.get(remote_ref_name)
+        if remote_ref is None:
+            return False
+
+        if remote_ref.target == repo.head.target:
+            print("Already up to date.")
+            return True
+        if not repo.is_shallow:
+            analysis, _ = repo.merge_analysis(remote_ref.target)
+            if not analysis & pygit2.GIT_MERGE_ANALYSIS_FASTFORWARD:
+                return False
+
+        # 默认的 SAFE 策略与 git pull 一致，不会覆盖本地修改
+        repo.checkout_tree(repo.get(remote_ref.target))
+        repo.head.set_target(remote_ref.target)
+        print(f"Fast-forward {branch} -> {remote_ref.target}")
+        return True
+    except (pygit2.GitError, KeyError, TypeError) as e:
+        # TypeError: 旧版 pygit2 不支持 depth/proxy 参数
+        print(f"pygit2 拉取失败，改用 git 命令: {e}")
+        return False
+
+
+_getaddrinfo = socket.getaddrinfo
+
+
+@functools.lru_cache(maxsize=128)
+def _cached_getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    return tuple(_getaddrinfo(host, port, family, type, proto, flags))
+
+
+def getaddrinfo(host, port, family=0, type=0, proto=0, flags=0):
+    """带缓存的 DNS 解析，同一主机在一次运行内只解析一次（解析失败不缓存）"""
+    return list(_cached_getaddrinfo(host, port, family, type, proto, flags))
+
+
+# 替换全局解析函数，urllib3/urllib 建立的每个连接都会经过缓存
+socket.getaddrinfo = getaddrinfo
+
+
+# 下载时每次读取/写入的块大小
+CHUNK_SIZE = 1024 * 1024
+# 下载进度输出间隔：终端中每秒刷新一次，输出到日志时每 64 MiB 输出一行
+PROGRESS_INTERVAL = 1.0
+PROGRESS_BYTES = 64 * 1024 * 1024
+# 只有主线程会收到 Ctrl-C，由它设置该事件通知并发下载的线程停止
+_CANCELLED = threading.Event()
+
+USER_AGENT = "Mozilla/5.0 (compatible; sync.py)"
+
+# 下载中的临时文件后缀，中断后下次运行可基于它断点续传
+PARTIAL_SUFFIX = ".partial"
+# 记录 ETag/Last-Modified 的元数据文件后缀，用于条件请求
+META_SUFFIX = ".sync-meta.json"
+# raw 文件 URL 特征（raw.githubusercontent.com、GitLab /-/raw/、Gitee /raw/、/blob/）
+_RAW_RE = re.compile(r"raw\.githubusercontent\.com|/-/raw/|/raw/|/blob/")
+# 内置的 GitHub 加速代理地址
+PROXY_BASES = {
+    "ghproxy": "https://gh-proxy.com/",
+    "mirror": "https://mirror.ghproxy.com/",
+}
+
+# 支持直接构建 raw URL 的 Git 平台（在整个 URL 中查找，兼容 www. 前缀和已加代理前缀的地址）
+_PROVIDER_RE = re.compile(r"(github|gitlab|gitee)\.com")
+# 各 Git 平台 raw 文件 URL 的前缀，键为平台名，参数为去掉 .git 后缀的仓库地址
+# GitHub: https://github.com/user/repo -> https://raw.githubusercontent.com/user/repo/branch/path
+# GitLab: https://gitlab.com/user/repo -> https://gitlab.com/user/repo/-/raw/branch/path
+# Gitee:  https://gitee.com/user/repo -> https://gitee.com/user/repo/raw/branch/path
+_RAW_URL_PREFIXES = {
+    "github": lambda base: re.sub(r"(?:www\.)?github\.com", "raw.githubusercontent.com", base) + "/",
+    "gitlab": lambda base: f"{base}/-/raw/",
+    "gitee": lambda base: f"{base}/raw/",
+}
+
+# 通过归档同步的目录中的标记文件，下次同步时据此识别目标目录
+ARCHIVE_MARKER = ".sync-archive.json"
+
+# Python 3.12+（及安全补丁版本）支持解压过滤器，拒绝越界路径和危险链接
+TAR_EXTRACT_OPTIONS = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+
+# 可重试的 HTTP 状态码（超时、限流、服务端临时错误）
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# 可重试的网络错误码（连接被重置/拒绝、网络或主机不可达、超时）
+RETRY_ERRNOS = {
+    errno.ECONNRESET,
+    errno.ECONNREFUSED,
+    errno.ECONNABORTED,
+    errno.EHOSTUNREACH,
+    errno.ENETUNREACH,
+    errno.ENETDOWN,
+    errno.ETIMEDOUT,
+    errno.EPIPE,
+}
+
+# 全局 HTTP 连接池，同一次运行内的下载复用 TCP/TLS 连接（未安装 urllib3 时回退到 urllib）
+# 重试统一由 download() 处理，连接池只负责跟随重定向
+_POOL = None
+_PROXY_POOLS = {}
+if urllib3 is not None:
+    _POOL_OPTIONS = {
+        "num_pools": 8,
+        "maxsize": 16,
+        "retries": urllib3.Retry(
+            connect=0,
+            read=0,
+            status=0,
+            other=0,
+            redirect=5,
+            raise_on_status=False,
+        ),
+    }
+    _POOL = urllib3.PoolManager(**_POOL_OPTIONS)
+
+
+def get_pool(url):
+    """按 HTTP(S)_PROXY/NO_PROXY 环境变量选择连接池，与 urllib 的代理行为一致；
+    未安装 urllib3 或代理类型不受支持（如 socks）时返回 None，交给 urllib 处理"""
+    if _POOL is None:
+        return None
+    parsed = urllib.parse.urlparse(url)
+    proxy = urllib.request.getproxies().get(parsed.scheme)
+    if not proxy or urllib.request.proxy_bypass(parsed.hostname or ""):
+        return _POOL
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    pool = _PROXY_POOLS.get(proxy)
+    if pool is None:
+        proxy_parsed = urllib.parse.urlparse(proxy)
+        if proxy_parsed.scheme not in ("http", "https"):
+            return None
+        proxy_headers = None
+        if proxy_parsed.username is not None:
+            # ProxyManager 不会读取代理地址中的账号密码，需要自行生成 Proxy-Authorization
+            auth = urllib.parse.unquote(proxy_parsed.username) + ":" + urllib.parse.unquote(proxy_parsed.password or "")
+            proxy_headers = urllib3.make_headers(proxy_basic_auth=auth)
+        pool = urllib3.ProxyManager(proxy, proxy_headers=proxy_headers, **_POOL_OPTIONS)
+        _PROXY_POOLS[proxy] = pool
+    return pool
+
+
+def build_headers(args):
+    """构建下载请求头"""
+    # 文本文件（脚本、配置）启用 gzip 压缩传输可大幅减少下载量
+    headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip"}
+    # 添加认证 Token
+    if args.auth_token:
+        headers["Authorization"] = f"token {args.auth_token}"
+    return headers
+
+
+@contextlib.contextmanager
+def open_url(url, headers):
+    """打开 URL 并返回可读取的响应流，错误统一以 urllib.error 异常抛出"""
+    pool = get_pool(url)
+    if pool is None:
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req, timeout=300) as response:
+            yield response
+        return
+
+    try:
+        response = pool.request(
+            "GET",
+            url,
+            headers=headers,
+            preload_content=False,
+            # 由 save_stream 按 Content-Length 校验完整性：urllib3 2.x 的校验会丢弃出错那次 read 中已收到的数据，无法续传
+            enforce_content_length=False,
+            timeout=urllib3.Timeout(connect=10, read=300),
+        )
+    except urllib3.exceptions.HTTPError as e:
+        raise urllib.error.URLError(e)
+
+    # 重定向已由连接池处理，剩余的 3xx（如 304）与 4xx/5xx 一样按 urllib 的行为抛出
+    if response.status >= 300:
+        response.drain_conn()
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+
+    try:
+        yield response
+    except urllib3.exceptions.HTTPError as e:
+        response.close()
+        raise urllib.error.URLError(e)
+    except BaseException:
+        response.close()
+        raise
+    # 读取完毕后归还连接，供后续请求复用
+    response.release_conn()
+
+
+def is_urllib3_response(response):
+    """判断响应是否来自 urllib3 连接池（否则为 urllib 的响应）"""
+    return urllib3 is not None and isinstance(response, urllib3.HTTPResponse)
+
+
+def decoded_stream(response):
+    """返回按 Content-Encoding 解压后的响应流（urllib3 会自动解压，urllib 需要手动处理）"""
+    if not is_urllib3_response(response) and response.headers.get("Content-Encoding") == "gzip":
+        return gzip.GzipFile(fileobj=response)
+    return response
+
+
+def format_progress(name, done, total):
+    """格式化下载进度"""
+    if total:
+        return f"{name}: {done}/{total} 字节 ({done * 100 // total}%)"
+    return f"{name}: {done} 字节"
+
+
+def save_stream(response, dest, append=False, max_size=0):
+    """将响应流分块写入文件并输出进度，超过 max_size 字节时中止，返回文件大小"""
+    done = start = os.path.getsize(dest) if append else 0
+
+    # Content-Length 是编码后的长度，只有未压缩时才能用于计算进度；续传时为剩余部分的长度
+    total = 0
+    if response.headers.get("Content-Encoding", "identity") == "identity":
+        total = int(response.headers.get("Content-Length") or 0)
+        if total:
+            total += done
+    if max_size and total > max_size:
+        raise OSError(errno.EFBIG, f"文件大小 {total} 字节超过限制 {max_size} 字节")
+
+    name = os.path.basename(dest)
+    if name.endswith(PARTIAL_SUFFIX):
+        name = name[:-len(PARTIAL_SUFFIX)]
+    interactive = sys.stdout.isatty()
+    last_time, last_done = time.monotonic(), done
+    stream = decoded_stream(response)
+    # 每个线程复用一块缓冲区：readinto 直接读入、os.write 直接写出，避免每块分配新的 bytes 对象
+    buf = bytearray(CHUNK_SIZE)
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+    fd = os.open(dest, flags, 0o666)
+    try:
+        while True:
+            if _CANCELLED.is_set():
+                raise KeyboardInterrupt
+            n = stream.readinto(buf)
+            if not n:
+                break
+            # memoryview 只在写出期间持有：urllib3 1.x 的 readinto 解压 gzip 后可能扩大缓冲区，存在导出时无法扩大
+            with memoryview(buf) as view:
+                written = 0
+                while written < n:
+                    written += os.write(fd, view[written:n])
+            done += n
+            if max_size and done > max_size:
+                raise OSError(errno.EFBIG, f"文件大小超过限制 {max_size} 字节")
+
+            now = time.monotonic()
+            if interactive and now - last_time >= PROGRESS_INTERVAL:
+                print("\r" + format_progress(name, done, total), end="", flush=True)
+                last_time = now
+            elif not interactive and done - last_done >= PROGRESS_BYTES:
+                print(format_progress(name, done, total), flush=True)
+                last_done = done
+
+        # 连接提前关闭时 read/readinto 只会返回 0，需要按 Content-Length 判断是否收完整；
+        # 已收到的数据都已写入，续传时从这里继续。urllib3 记录了收到的原始字节数，压缩传输时同样可以判断
+        length = int(response.headers.get("Content-Length") or 0)
+        if is_urllib3_response(response):
+            received = response.tell()
+        else:
+            received = done - start if total else length
+        if length and received != length:
+            raise http.client.IncompleteRead(b"", length - received)
+
+        # 落盘后再由调用方 os.replace，避免断电后出现内容不完整的目标文件
+        os.fsync(fd)
+    except EOFError as e:
+        # urllib 的响应经 GzipFile 解压，连接提前关闭时表现为压缩数据不完整
+        raise http.client.IncompleteRead(b"") from e
+    finally:
+        os.close(fd)
+
+    if interactive and done:
+        print("\r" + format_progress(name, done, total))
+    return os.path.getsize(dest)
+
+
+def load_sync_meta(path):
+    """读取文件对应的同步元数据，不存在或损坏时返回空字典"""
+    try:
+        with open(path + META_SUFFIX, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_sync_meta(path, url, response_headers):
+    """保存下载地址及响应中的 ETag/Last-Modified，供下次条件请求使用；两者都没有时不生成元数据文件"""
+    meta = {
+        "url": url,
+        "etag": response_headers.get("ETag"),
+        "last_modified": response_headers.get("Last-Modified"),
+    }
+    if not meta["etag"] and not meta["last_modified"]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path + META_SUFFIX)
+        return
+    with open(path + META_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+
+def discard_partial(dest):
+    """删除未完成的下载文件及其元数据"""
+    partial = dest + PARTIAL_SUFFIX
+    for path in (partial, partial + META_SUFFIX):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def lock_partial(partial, dest):
+    """打开并锁定部分文件，返回文件描述符；同一目标的重叠运行依次下载，避免互相截断写入"""
+    while True:
+        fd = os.open(partial, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    print(f"另一个同步进程正在下载 {dest}，等待其完成")
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+            # 等待期间文件可能已被前一个进程替换为目标文件或删除，此时需要重新打开
+            if os.path.samestat(os.fstat(fd), os.stat(partial)):
+                return fd
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def fetch(url, headers, dest, max_size=0):
+    """下载一次：文件未变化时跳过（返回 None），存在未完成的下载时断点续传"""
+    partial = dest + PARTIAL_SUFFIX
+    # 部分文件在整个下载与替换期间保持加锁
+    lock_fd = lock_partial(partial, dest)
+    try:
+        request_headers = dict(headers)
+
+        # 条件请求：服务端文件未变化时返回 304（下载地址变化后元数据不再适用）
+        if os.path.exists(dest):
+            meta = load_sync_meta(dest)
+            if meta.get("url") != url:
+                meta = {}
+            if meta.get("etag"):
+                request_headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                request_headers["If-Modified-Since"] = meta["last_modified"]
+
+        # 断点续传：仅当记录了部分文件的校验信息时才续传，If-Range 保证服务端文件变化后从头下载
+        resuming = False
+        offset = os.fstat(lock_fd).st_size
+        if offset:
+            partial_meta = load_sync_meta(partial)
+            if partial_meta.get("url") != url:
+                partial_meta = {}
+            validator = partial_meta.get("etag") or partial_meta.get("last_modified")
+            if validator:
+                request_headers["Range"] = f"bytes={offset}-"
+                request_headers["If-Range"] = validator
+                # Range 针对的是编码后的字节，续传时请求未压缩的内容以与本地已解压的数据对齐
+                request_headers["Accept-Encoding"] = "identity"
+                resuming = True
+
+        try:
+            with open_url(url, request_headers) as response:
+                append = resuming and response.status == 206
+                if append:
+                    print(f"断点续传: 从 {offset} 字节处继续下载")
+                else:
+                    save_sync_meta(partial, url, response.headers)
+                save_stream(response, partial, append, max_size)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                discard_partial(dest)
+                return None
+            if e.code == 416 and resuming:
+                # 部分文件与服务端不匹配，丢弃后重新下载
+                discard_partial(dest)
+                return fetch(url, headers, dest, max_size)
+            raise
+
+        # 原子替换：目标文件要么保持旧内容，要么是完整的新内容；替换前沿用已有文件的权限（如脚本的可执行位）
+        with contextlib.suppress(FileNotFoundError):
+            os.chmod(partial, stat.S_IMODE(os.stat(dest).st_mode))
+        os.replace(partial, dest)
+        # 新内容没有校验信息时删除旧的元数据，避免用旧的 ETag 误判为未变化
+        if os.path.exists(partial + META_SUFFIX):
+            os.replace(partial + META_SUFFIX, dest + META_SUFFIX)
+        elif os.path.exists(dest + META_SUFFIX):
+            os.remove(dest + META_SUFFIX)
+        return os.path.getsize(dest)
+    except BaseException as e:
+        # 非临时性错误（如 HTTP 404、磁盘写入失败）或用户中断时在持有锁期间清理临时文件，网络中断时保留以便下次续传
+        if not isinstance(e, (OSError, http.client.HTTPException)) or not is_retryable(e):
+            discard_partial(dest)
+        raise
+    finally:
+        os.close(lock_fd)
+
+
+def iter_error_chain(e):
+    """依次返回异常及其包装的底层异常（URLError.reason、urllib3 包装的原始异常、__cause__ 等）"""
+    pending = [e]
+    seen = set()
+    while pending:
+        e = pending.pop(0)
+        if id(e) in seen:
+            continue
+        seen.add(id(e))
+        yield e
+        for cause in (getattr(e, "reason", None), e.__cause__, e.__context__, *e.args):
+            if isinstance(cause, BaseException):
+                pending.append(cause)
+
+
+def is_retryable(e):
+    """判断下载错误是否为可重试的临时性错误，401/403/404、证书错误、域名不存在等直接失败"""
+    if isinstance(e, urllib.error.HTTPError):
+        return e.code in RETRY_STATUS_CODES
+
+    causes = list(iter_error_chain(e))
+
+    # 先检查无法恢复的底层错误（urllib3 会把域名解析失败包装成连接超时类异常）
+    for cause in causes:
+        if isinstance(cause, socket.gaierror):
+            # 仅 DNS 临时失败可重试
+            return cause.errno == socket.EAI_AGAIN
+        if isinstance(cause, ssl.SSLCertVerificationError):
+            return False
+
+    for cause in causes:
+        if isinstance(cause, (TimeoutError, ConnectionError, http.client.HTTPException)):
+            return True
+        if getattr(cause, "errno", None) in RETRY_ERRNOS:
+            return True
+        if urllib3 is not None and isinstance(cause, (urllib3.exceptions.TimeoutError, urllib3.exceptions.ProtocolError)):
+            return True
+    return False
+
+
+def download(url, headers, dest, retries=3, backoff=1.0, max_size=0):
+    """下载 URL 到目标文件，临时性错误按指数退避重试，返回文件大小（文件未变化时返回 None）"""
+    for attempt in range(retries + 1):
+        try:
+            return fetch(url, headers, dest, max_size)
+        except (OSError, http.client.HTTPException) as e:
+            # 临时文件已由 fetch 按错误类型清理或保留
+            if not is_retryable(e) or attempt >= retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            print(f"下载出错: {getattr(e, 'reason', e)}，{delay:g} 秒后重试 ({attempt + 1}/{retries})")
+            if _CANCELLED.wait(delay):
+                raise KeyboardInterrupt
 
 
 def build_proxy_url(url, proxy_type, proxy_url):
-    """构建代理 URL"""
-    if not proxy_type or proxy_type == "none":
+    """构建代理 URL（proxy_url 需已在参数解析时规范为以 / 结尾）"""
+    if not proxy_type or proxy_type == "none" or not url.startswith("http"):
         return url
-    
-    proxy_base = ""
-    if proxy_type == "ghproxy":
-        proxy_base = "https://gh-proxy.com/"
-    elif proxy_type == "mirror":
-        proxy_base = "https://mirror.ghproxy.com/"
-    elif proxy_type == "custom" and proxy_url:
-        proxy_base = proxy_url.rstrip("/") + "/"
-    
-    if proxy_base and url.startswith("http"):
-        return proxy_base + url
-    
-    return url
+
+    proxy_base = proxy_url if proxy_type == "custom" else PROXY_BASES.get(proxy_type)
+    return f"{proxy_base}{url}" if proxy_base else url
+
+
+def strip_dotgit(url):
+    """去掉 URL 末尾的 .git 后缀（rstrip(".git") 会误删 t、i、g 等结尾字符）"""
+    return url[:-4] if url.endswith(".git") else url
+
+
+def raw_url_builder(source_url):
+    """按仓库所在平台确定 raw URL 格式并预先算好前缀，返回 (branch, file_path) -> raw URL 的构建函数"""
+    match = _PROVIDER_RE.search(source_url)
+    # 通用：尝试 GitHub 风格
+    make_prefix = _RAW_URL_PREFIXES.get(match.group(1) if match else None, lambda base: f"{base}/raw/")
+    prefix = make_prefix(strip_dotgit(source_url.rstrip("/")))
+    return lambda branch, file_path: f"{prefix}{branch}/{file_path}"
+
+
+def describe_error(e):
+    """将下载异常转换为可读的错误信息"""
+    if isinstance(e, urllib.error.HTTPError):
+        return f"HTTP 状态码: {e.code}"
+    if isinstance(e, urllib.error.URLError):
+        return str(e.reason)
+    return str(e)
 
 
 def sync_git_file(args, repo_url, env):
-    """从 Git 仓库同步单个文件（通过 raw URL 下载）"""
+    """从 Git 仓库同步文件（通过 raw URL 下载，多个文件并发下载）"""
     source_url = args.source_url
-    file_path = args.path
     branch = args.branch or "main"
-    dest = args.target_path
-    
-    # 构建 raw 文件 URL
-    # GitHub: https://github.com/user/repo -> https://raw.githubusercontent.com/user/repo/branch/path
-    # GitLab: https://gitlab.com/user/repo -> https://gitlab.com/user/repo/-/raw/branch/path
-    # Gitee:  https://gitee.com/user/repo -> https://gitee.com/user/repo/raw/branch/path
-    
-    raw_url = None
-    if "github.com" in source_url:
-        # GitHub
-        base = source_url.replace("github.com", "raw.githubusercontent.com").rstrip(".git")
-        raw_url = f"{base}/{branch}/{file_path}"
-    elif "gitlab.com" in source_url:
-        # GitLab
-        base = source_url.rstrip(".git")
-        raw_url = f"{base}/-/raw/{branch}/{file_path}"
-    elif "gitee.com" in source_url:
-        # Gitee
-        base = source_url.rstrip(".git")
-        raw_url = f"{base}/raw/{branch}/{file_path}"
-    else:
-        # 通用：尝试 GitHub 风格
-        base = source_url.rstrip(".git")
-        raw_url = f"{base}/raw/{branch}/{file_path}"
-    
-    # 应用代理
-    raw_url = build_proxy_url(raw_url, args.proxy, args.proxy_url)
-    
-    print(f"下载单文件: {raw_url}")
-    print(f"目标路径: {dest}")
-    
-    # 确保目标目录存在
-    parent_dir = os.path.dirname(dest)
-    if parent_dir:
-        os.makedirs(parent_dir, exist_ok=True)
-    
-    # 创建请求
-    req = urllib.request.Request(raw_url)
-    
-    # 添加认证 Token
-    if args.auth_token:
-        req.add_header("Authorization", f"token {args.auth_token}")
-    
-    req.add_header("User-Agent", "Mozilla/5.0 (compatible; sync.py)")
-    
-    try:
-        with urllib.request.urlopen(req, timeout=300) as response:
-            content = response.read()
-            
-            with open(dest, "wb") as f:
-                f.write(content)
-            
-            print(f"文件大小: {len(content)} 字节")
-            print("同步完成")
-    except urllib.error.HTTPError as e:
-        print(f"下载失败, HTTP 状态码: {e.code}")
-        sys.exit(1)
-    except urllib.error.URLError as e:
-        print(f"下载失败: {e.reason}")
+    paths = args.path
+
+    # 平台只识别一次，之后每个路径只需拼接字符串
+    build_raw_url = raw_url_builder(source_url)
+
+    # 单个文件直接写入目标路径；多个文件时目标路径视为目录，保留仓库内的相对路径
+    tasks = []
+    for file_path in paths:
+        dest = args.target_path if len(paths) == 1 else os.path.join(args.target_path, file_path)
+
+        # 构建 raw 文件 URL 并应用代理
+        raw_url = build_proxy_url(build_raw_url(branch, file_path), args.proxy, args.proxy_url)
+
+        print(f"下载单文件: {raw_url}")
+        print(f"目标路径: {dest}")
+
+        # 确保目标目录存在
+        parent_dir = os.path.dirname(dest)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+
+        tasks.append((raw_url, dest))
+
+    headers = build_headers(args)
+
+    # 连接池线程安全，并发下载时同样复用连接
+    # 未使用 io_uring：下载均为 HTTPS，TLS 在用户态由 ssl 模块完成，内核批量收发无法绕过；
+    # 瓶颈在网络往返而非系统调用次数，线程池的 socket/文件读写都会释放 GIL
+    failures = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(args.jobs, len(tasks)))) as executor:
+        futures = [
+            executor.submit(
+                download, raw_url, headers, dest, args.retries, args.retry_backoff, args.max_size * 1024 * 1024
+            )
+            for raw_url, dest in tasks
+        ]
+        try:
+            for (raw_url, dest), future in zip(tasks, futures):
+                try:
+                    size = future.result()
+                except (OSError, http.client.HTTPException) as e:
+                    failures += 1
+                    print(f"下载失败: {dest}: {describe_error(e)}")
+                else:
+                    if size is None:
+                        print(f"文件未变化，跳过下载 ({dest})")
+                    else:
+                        print(f"文件大小: {size} 字节 ({dest})")
+        except KeyboardInterrupt:
+            # 取消未开始的任务，通知下载中的线程在下一块数据前停止，等它们退出后清理临时文件
+            _CANCELLED.set()
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            for raw_url, dest in tasks:
+                discard_partial(dest)
+            raise
+
+    if failures:
+        print(f"同步失败: {failures}/{len(tasks)} 个文件下载失败")
         sys.exit(1)
 
+    print("同步完成")
+
 
 def is_raw_file_url(url):
     """检测是否是 raw 文件 URL"""
-    raw_patterns = [
-        "raw.githubusercontent.com",
-        "/raw/",
-        "/-/raw/",
-        "/blob/",
-    ]
-    return any(pattern in url for pattern in raw_patterns)
+    return bool(_RAW_RE.search(url))
 
 
 def get_repo_name(url):
     """从 Git URL 中提取仓库名"""
     # 去掉末尾的 .git
-    url = url.rstrip("/").rstrip(".git")
+    url = strip_dotgit(url.rstrip("/"))
     # 提取最后一部分作为仓库名
     return os.path.basename(url)
 
 
+def write_sparse_checkout(dest, paths):
+    """按 cone 模式格式写入 .git/info/sparse-checkout（与 git sparse-checkout set --cone 生成的规则一致）"""
+    dirs = {p.strip("/") for p in paths if p.strip("/")}
+    # 已被上级目录包含的路径无需单独列出，否则父目录的排除规则会把它们重新排除
+    dirs = {d for d in dirs if not any(d.startswith(other + "/") for other in dirs)}
+
+    lines = ["/*", "!/*/"]
+    parents = set()
+    for d in sorted(dirs):
+        parts = d.split("/")
+        for i in range(1, len(parts)):
+            parent = "/".join(parts[:i])
+            if parent not in parents:
+                parents.add(parent)
+                lines += [f"/{parent}/", f"!/{parent}/*/"]
+        lines.append(f"/{d}/")
+
+    info_dir = os.path.join(dest, ".git", "info")
+    os.makedirs(info_dir, exist_ok=True)
+    with open(os.path.join(info_dir, "sparse-checkout"), "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def sparse_clone(repo_url, dest, branch, paths, env):
+    """使用 tree:0 部分克隆 + sparse-checkout 拉取指定目录，失败时清理目标目录并返回 False"""
+    ok = run([
+        "git", "clone",
+        "--depth", "1",
+        "--filter=tree:0",
+        "--sparse",
+        "-b", branch,
+        repo_url,
+        dest
+    ], env=env, check=False) == 0
+    if ok:
+        ok = run(["git", "sparse-checkout", "set", "--cone", *paths], cwd=dest, env=env, check=False) == 0
+
+    if not ok:
+        print("tree:0 稀疏克隆失败，回退到 blob:none 稀疏检出")
+        shutil.rmtree(dest, ignore_errors=True)
+    return ok
+
+
+def is_nonempty_dir(path):
+    """判断目录是否非空，只读取第一个目录项"""
+    with os.scandir(path) as it:
+        return next(it, None) is not None
+
+
+def build_archive_url(source_url, branch):
+    """构建 GitHub/GitLab 仓库的 tar.gz 归档地址，其他平台返回 None"""
+    parsed = urllib.parse.urlparse(source_url)
+    parts = parsed.path.strip("/").split("/")
+    if len(parts) < 2:
+        return None
+    parts[-1] = strip_dotgit(parts[-1])
+    repo_path = "/".join(parts)
+
+    # GitHub: https://codeload.github.com/user/repo/tar.gz/refs/heads/branch
+    # GitLab: https://gitlab.com/user/repo/-/archive/branch/repo-branch.tar.gz
+    if parsed.netloc == "github.com" and len(parts) == 2:
+        return f"https://codeload.github.com/{repo_path}/tar.gz/refs/heads/{branch}"
+    if parsed.netloc == "gitlab.com":
+        return f"https://gitlab.com/{repo_path}/-/archive/{branch}/{parts[-1]}-{branch}.tar.gz"
+    return None
+
+
+def extract_archive(response, dest, paths):
+    """流式解压归档，只提取指定路径下的成员（去掉归档顶层目录），返回提取的成员数"""
+    count = 0
+    # 归档数据需在用户态解压，无法用 sendfile 零拷贝；改用 1 MiB 的读取与成员复制缓冲区（默认分别为 10 KiB、16 KiB）
+    with tarfile.open(
+        fileobj=decoded_stream(response),
+        mode="r|gz",
+        bufsize=CHUNK_SIZE,
+        copybufsize=CHUNK_SIZE,
+    ) as tar:
+        for member in tar:
+            # 归档顶层目录形如 repo-branch/，去掉后与仓库内路径对应
+            name = member.name.partition("/")[2]
+            if not any(name == p or name.startswith(p + "/") for p in paths):
+                continue
+            if os.path.isabs(name) or ".." in name.split("/"):
+                continue
+            if member.islnk():
+                # 硬链接目标同样带有归档顶层目录
+                member.linkname = member.linkname.partition("/")[2]
+            if not TAR_EXTRACT_OPTIONS:
+                # 旧版 Python 没有解压过滤器，需要自行跳过特殊文件和指向解压目录之外的链接
+                if not (member.isfile() or member.isdir() or member.issym() or member.islnk()):
+                    continue
+                if member.issym() or member.islnk():
+                    base = os.path.dirname(name) if member.issym() else ""
+                    target = os.path.normpath(os.path.join(base, member.linkname))
+                    if os.path.isabs(target) or target == ".." or target.startswith("../"):
+                        continue
+            member.name = name
+            tar.extract(member, dest, **TAR_EXTRACT_OPTIONS)
+            count += 1
+    return count
+
+
+def fetch_archive(url, headers, dest, paths, retries=3, backoff=1.0):
+    """下载归档并解压指定路径到 dest，临时性错误按指数退避重试，返回提取的成员数"""
+    for attempt in range(retries + 1):
+        try:
+            with open_url(url, headers) as response:
+                return extract_archive(response, dest, paths)
+        except (OSError, http.client.HTTPException) as e:
+            if not is_retryable(e) or attempt >= retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            print(f"下载出错: {getattr(e, 'reason', e)}，{delay:g} 秒后重试 ({attempt + 1}/{retries})")
+            time.sleep(delay)
+            # 丢弃上次解压了一半的内容
+            shutil.rmtree(dest)
+            os.mkdir(dest)
+
+
+def sync_git_archive(args, dest, branch):
+    """下载仓库归档并只解压指定目录，无需 git clone；不适用或首次同步失败时返回 False，
+    之前已通过归档同步的目录再次同步失败时直接报错退出"""
+    # 私有仓库与 HTTP 代理仍交给 git 处理
+    if args.auth_token or args.http_proxy:
+        return False
+
+    archive_url = build_archive_url(args.source_url, branch)
+    if not archive_url:
+        return False
+
+    # 只写入不存在/空的目录或之前由同一仓库归档同步的目录，其他目录交给 git clone 的非空检查，避免删除用户文件
+    resync = False
+    if os.path.lexists(dest):
+        if not os.path.isdir(dest):
+            return False
+        if is_nonempty_dir(dest):
+            try:
+                with open(os.path.join(dest, ARCHIVE_MARKER), "r", encoding="utf-8") as f:
+                    marker = json.load(f)
+            except (OSError, ValueError):
+                return False
+            if not isinstance(marker, dict) or marker.get("source_url") != args.source_url:
+                return False
+            resync = True
+
+    archive_url = build_proxy_url(archive_url, args.proxy, args.proxy_url)
+
+    paths = [p.strip("/") for p in args.path]
+    print(f"下载仓库归档: {archive_url}")
+
+    # 先解压到临时目录，成功后再逐个替换目标路径，失败时不影响已有文件
+    parent_dir = os.path.dirname(os.path.abspath(dest))
+    tmp_dir = tempfile.mkdtemp(prefix=".sync-", dir=parent_dir)
+    try:
+        count = fetch_archive(archive_url, build_headers(args), tmp_dir, paths, args.retries, args.retry_backoff)
+
+        # 归档不包含 export-ignore 的路径，缺少任何路径时都不写入目标目录，避免与 git clone 的结果不一致
+        missing = [p for p in paths if not os.path.lexists(os.path.join(tmp_dir, p))]
+        if missing:
+            raise FileNotFoundError(f"归档中不存在路径: {', '.join(missing)}")
+
+        os.makedirs(dest, exist_ok=True)
+        for p in paths:
+            src = os.path.join(tmp_dir, p)
+            target = os.path.join(dest, p)
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target)
+            elif os.path.lexists(target):
+                os.remove(target)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(src, target)
+
+        with open(os.path.join(dest, ARCHIVE_MARKER), "w", encoding="utf-8") as f:
+            json.dump({"source_url": args.source_url, "branch": branch, "paths": paths}, f)
+    except (OSError, http.client.HTTPException, tarfile.TarError) as e:
+        if resync:
+            # 目录非空，改用 git clone 只会被非空检查拦下
+            print(f"错误: 归档同步失败: {describe_error(e)}")
+            sys.exit(1)
+        print(f"归档同步失败，改用 git clone: {describe_error(e)}")
+        return False
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    print(f"已解压 {count} 个文件/目录到: {dest}")
+    return True
+
+
 def sync_git(args):
     """Git 仓库同步"""
     env = os.environ.copy()
@@ -159,9 +890,10 @@ def sync_git(args):
         sync_git_file(args, repo_url, env)
         return
 
-    # 如果目标路径是已存在的目录且不是 git 仓库，自动追加仓库名作为子目录
+    # 如果目标路径是已存在的目录且不是 git 仓库（也不是归档同步的目录），自动追加仓库名作为子目录
     git_dir = os.path.join(dest, ".git")
-    if os.path.isdir(dest) and not os.path.exists(git_dir):
+    archive_marker = os.path.join(dest, ARCHIVE_MARKER)
+    if os.path.isdir(dest) and not os.path.exists(git_dir) and not os.path.exists(archive_marker):
         repo_name = get_repo_name(args.source_url)
         dest = os.path.join(dest, repo_name)
         print(f"目标路径自动追加仓库名: {dest}")
@@ -173,54 +905,59 @@ def sync_git(args):
     if is_existing_repo:
         # 已存在仓库，执行 git pull
         print(f"检测到已存在仓库，执行 git pull")
-        
-        # 先切换分支
-        if branch:
-            try:
-                run(["git", "checkout", branch], cwd=dest, env=env)
-            except:
-                pass
-        
-        run(["git", "pull"], cwd=dest, env=env)
+
+        if pygit2 is None or not pygit2_pull(dest, branch, args):
+            # 先切换分支
+            if branch:
+                try:
+                    run(["git", "checkout", branch], cwd=dest, env=env)
+                except:
+                    pass
+
+            run(["git", "pull"], cwd=dest, env=env)
     else:
-        # 新仓库，执行 git clone
-        print(f"执行 git clone")
-        
         # 确保父目录存在
         parent_dir = os.path.dirname(dest)
         if parent_dir:
             os.makedirs(parent_dir, exist_ok=True)
 
+        # GitHub/GitLab 上只拉取部分目录时，直接下载归档解压，省去 clone
+        if args.path and sync_git_archive(args, dest, branch):
+            print("同步完成")
+            return
+
+        # 新仓库，执行 git clone
+        print(f"执行 git clone")
+
         # 如果目标目录已存在且不为空，报错提示
-        if os.path.exists(dest) and os.listdir(dest):
+        if os.path.exists(dest) and is_nonempty_dir(dest):
             print(f"错误: 目标目录 '{dest}' 已存在且不为空，无法执行 git clone")
             print("提示: 请清空目标目录或指定一个新目录")
             sys.exit(1)
 
         # 稀疏 clone（如果指定了 path）
         if args.path:
-            run([
-                "git", "clone",
-                "--depth", "1",
-                "--filter=blob:none",
-                "--no-checkout",
-                "-b", branch,
-                repo_url,
-                dest
-            ], env=env)
+            # 优先 --filter=tree:0 --sparse 一步完成，只拉取所需目录的 tree/blob
+            if not sparse_clone(repo_url, dest, branch, args.path, env):
+                # 服务端不支持 tree 过滤等情况，回退到 blob:none 的稀疏检出流程
+                # clone 时直接开启 cone 模式的稀疏检出，再写入规则文件，省去 sparse-checkout init/set 两次调用
+                run([
+                    "git", "clone",
+                    "--depth", "1",
+                    "--filter=blob:none",
+                    "--no-checkout",
+                    "-c", "core.sparseCheckout=true",
+                    "-c", "core.sparseCheckoutCone=true",
+                    "-b", branch,
+                    repo_url,
+                    dest
+                ], env=env)
 
-            run(["git", "sparse-checkout", "init", "--cone"], cwd=dest, env=env)
-            run(["git", "sparse-checkout", "set", args.path], cwd=dest, env=env)
-            run(["git", "checkout"], cwd=dest, env=env)
+                write_sparse_checkout(dest, args.path)
+                run(["git", "checkout"], cwd=dest, env=env)
         else:
             # 普通 clone
-            run([
-                "git", "clone",
-                "--depth", "1",
-                "-b", branch,
-                repo_url,
-                dest
-            ], env=env)
+            git_clone(repo_url, dest, branch, args, env)
 
     print("同步完成")
 
@@ -249,32 +986,42 @@ def sync_url(args):
     if parent_dir:
         os.makedirs(parent_dir, exist_ok=True)
 
-    # 创建请求
-    req = urllib.request.Request(download_url)
-    
-    # 添加认证 Token
-    if args.auth_token:
-        req.add_header("Authorization", f"token {args.auth_token}")
-    
-    # 添加 User-Agent
-    req.add_header("User-Agent", "Mozilla/5.0 (compatible; sync.py)")
+    headers = build_headers(args)
 
     try:
-        with urllib.request.urlopen(req, timeout=300) as response:
-            content = response.read()
-            
-            with open(dest, "wb") as f:
-                f.write(content)
-            
-            print(f"目标路径: {dest}")
-            print(f"文件大小: {len(content)} 字节")
-            print("同步完成")
+        size = download(download_url, headers, dest, args.retries, args.retry_backoff, args.max_size * 1024 * 1024)
+
+        print(f"目标路径: {dest}")
+        if size is None:
+            print("文件未变化，跳过下载")
+        else:
+            print(f"文件大小: {size} 字节")
+        print("同步完成")
     except urllib.error.HTTPError as e:
         print(f"下载失败, HTTP 状态码: {e.code}")
         sys.exit(1)
     except urllib.error.URLError as e:
         print(f"下载失败: {e.reason}")
         sys.exit(1)
+    except (OSError, http.client.HTTPException) as e:
+        print(f"下载失败: {e}")
+        sys.exit(1)
+
+
+def non_negative_int(value):
+    """argparse 类型：非负整数"""
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"必须是非负整数: {value}")
+    return number
+
+
+def non_negative_float(value):
+    """argparse 类型：非负有限浮点数"""
+    number = float(value)
+    if not 0 <= number < float("inf"):
+        raise argparse.ArgumentTypeError(f"必须是非负数: {value}")
+    return number
 
 
 def main():
@@ -288,10 +1035,12 @@ def main():
                         help="目标路径")
     parser.add_argument("--branch", default="main", 
                         help="Git 分支名（仅 git 类型有效）")
-    parser.add_argument("--path", 
-                        help="仅拉取指定文件或目录（仅 git 类型有效）")
+    parser.add_argument("--path", nargs="+",
+                        help="仅拉取指定文件或目录，可指定多个（仅 git 类型有效）")
     parser.add_argument("--single-file", action="store_true",
                         help="单文件模式，直接下载指定文件而非 sparse-checkout（需配合 --path 使用）")
+    parser.add_argument("--jobs", type=int, default=8,
+                        help="单文件模式下并发下载的文件数")
     parser.add_argument("--proxy", choices=["none", "ghproxy", "mirror", "custom"], default="none",
                         help="代理类型")
     parser.add_argument("--proxy-url", 
@@ -300,9 +1049,19 @@ def main():
                         help="认证 Token（用于私有仓库）")
     parser.add_argument("--http-proxy", 
                         help="HTTP 代理（如 http://127.0.0.1:7890）")
+    parser.add_argument("--retries", type=non_negative_int, default=3,
+                        help="下载遇到临时性网络错误时的最大重试次数")
+    parser.add_argument("--retry-backoff", type=non_negative_float, default=1.0,
+                        help="重试退避基数（秒），第 n 次重试前等待 backoff * 2^(n-1) 秒")
+    parser.add_argument("--max-size", type=non_negative_int, default=0,
+                        help="单个文件的最大下载大小（MB），超过时中止下载，0 表示不限制")
 
     args = parser.parse_args()
 
+    # 自定义代理地址统一以 / 结尾，拼接时无需再处理
+    if args.proxy_url:
+        args.proxy_url = args.proxy_url.rstrip("/") + "/"
+
     # 打印原始命令行参数
     print("参数:", " ".join(sys.argv[1:]))
 